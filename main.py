@@ -4,89 +4,176 @@ white_lotus_fetch_photos.py
 Fill the `photo_url` column of white_lotus_nodes_with_photos_skeleton.csv
 with the first infobox image on each character’s Fandom page
 (https://thewhitelotus.fandom.com).
-Requires: requests, beautifulsoup4, pandas, tqdm, polars
+Requires: aiohttp, aiolimiter, selectolax, tqdm, polars
 """
 
-import re, time, requests, pandas as pd, polars as pl
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-from tqdm import tqdm
+import asyncio, hashlib, random, time, aiohttp, polars as pl
+from aiolimiter import AsyncLimiter
+from pathlib import Path
+from selectolax.lexbor import LexborHTMLParser
+from tqdm.asyncio import tqdm
 
 # --- Configuration ---
 CSV_NODES_INPUT = "White_Lotus_Characters__completed_.csv"
 CSV_EDGES_INPUT = "white_lotus_edges_completed.csv"
 CSV_FINAL_OUTPUT = "output_character_relationships_with_details.csv"
+PAGE_CACHE_DIR = "fandom_cache" # Downloaded wiki pages, reused across runs
 
 # --- Constants ---
 USER_AGENT = "Mozilla/5.0 (compatible; WhiteLotusScraper/1.0)"
 HEADERS = {"User-Agent": USER_AGENT}
+REQUEST_TIMEOUT_SECONDS = 15 # Per connect and per socket read, not for the whole request
+MAX_CONNECTIONS_PER_HOST = 8
+MAX_CONCURRENT_REQUESTS = MAX_CONNECTIONS_PER_HOST # Requests past the semaphore never queue for a pooled connection
+KEEPALIVE_TIMEOUT_SECONDS = 30 # Keep idle connections to the wiki open between requests
+DNS_CACHE_TTL_SECONDS = 300
+REQUESTS_PER_SECOND = 10 # Be polite to the server
+MAX_RETRIES = 3 # Retries for rate-limited (429) and transient server errors, connection errors and timeouts
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRY_DELAY_SECONDS = 30 # Cap on the server's Retry-After, so one page can't stall the whole run
+INFOBOX_IMAGE_SELECTOR = "figure.pi-item.pi-image a.image-thumbnail img"
+INFOBOX_BYTE_RANGE = "0-32767" # The infobox <figure> is usually within the first ~30 KB of HTML
+PAGE_CACHE_TTL_SECONDS = 86400 * 7 # Wiki pages rarely change, so ignore Cache-Control and expire after a week
 
 def correct_initial_input_urls(csv_path: str):
     """Updates wiki_page_url for specified characters directly in the input CSV (skeleton file)."""
-    characters_to_update = [
-        {"name": "Tanya McQuoid", "new_wiki_url": "https://thewhitelotus.fandom.com/wiki/Tanya_McQuoid-Hunt"},
-        {"name": "Lucia", "new_wiki_url": "https://thewhitelotus.fandom.com/wiki/Lucia_Greco"},
-        {"name": "Belinda", "new_wiki_url": "https://thewhitelotus.fandom.com/wiki/Belinda_Lindsey"}
-    ]
+    corrected_wiki_urls = {
+        "Tanya McQuoid": "https://thewhitelotus.fandom.com/wiki/Tanya_McQuoid-Hunt",
+        "Lucia": "https://thewhitelotus.fandom.com/wiki/Lucia_Greco",
+        "Belinda": "https://thewhitelotus.fandom.com/wiki/Belinda_Lindsey"
+    }
     try:
-        df = pl.read_csv(csv_path)
         print(f"ℹ️  Correcting initial URLs in {csv_path}...")
-        for char_update in characters_to_update:
-            char_name = char_update["name"]
-            new_wiki_url = char_update["new_wiki_url"]
-            df = df.with_columns([
-                pl.when(pl.col("name") == char_name)
-                .then(pl.lit(new_wiki_url))
-                .otherwise(pl.col("wiki_page_url"))
-                .alias("wiki_page_url")
-            ])
+        # Apply every correction in a single pass; unmatched names keep their current URL.
+        # The result is collected before writing because it overwrites the file being scanned.
+        df = pl.scan_csv(csv_path).with_columns(
+            pl.col("name")
+            .replace_strict(corrected_wiki_urls, default=pl.col("wiki_page_url"), return_dtype=pl.String)
+            .alias("wiki_page_url")
+        ).collect()
+        for char_name, new_wiki_url in corrected_wiki_urls.items():
             print(f"    ✏️  {char_name}: Set wiki_page_url to {new_wiki_url} in {csv_path}")
         df.write_csv(csv_path)
         print(f"✅  Finished correcting initial URLs. Saved to {csv_path}")
     except Exception as e:
         print(f"❌ Error during initial URL correction: {e}")
 
-def first_static_image(page_url: str) -> str | None:
-    """Return the https://static.wikia.nocookie.net/... image URL in the infobox."""
-    r = requests.get(page_url, headers=HEADERS, timeout=15)
-    if r.status_code != 200:
-        return None
-    soup = BeautifulSoup(r.content, "html.parser")
+def cached_page_path(page_url: str, byte_range: str | None = None) -> Path:
+    """Return the on-disk cache location for a wiki page (or a byte range of it)."""
+    cache_key = page_url if byte_range is None else f"{page_url}#bytes={byte_range}"
+    return Path(PAGE_CACHE_DIR) / f"{hashlib.sha256(cache_key.encode('utf-8')).hexdigest()}.html"
+
+def read_cached_page(page_url: str, byte_range: str | None = None) -> bytes | None:
+    """Return the cached page body, or None if it is missing or older than the TTL."""
+    cache_path = cached_page_path(page_url, byte_range)
+    try:
+        if time.time() - cache_path.stat().st_mtime < PAGE_CACHE_TTL_SECONDS:
+            return cache_path.read_bytes()
+    except FileNotFoundError:
+        pass
+    return None
+
+def write_cached_page(page_url: str, content: bytes, byte_range: str | None = None):
+    """Store a downloaded page body in the on-disk cache."""
+    cache_path = cached_page_path(page_url, byte_range)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    cache_path.write_bytes(content)
+
+def retry_delay_seconds(attempt: int, retry_after: str | None) -> float:
+    """Return how long to wait before retrying: the server's Retry-After if given in seconds (capped), else exponential backoff with jitter."""
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_DELAY_SECONDS)
+    return 2 ** attempt + random.random()
+
+async def download_page(session: aiohttp.ClientSession, page_url: str, semaphore: asyncio.Semaphore, limiter: AsyncLimiter, byte_range: str | None = None) -> bytes | None:
+    """Return the page body (only the requested byte range if given), using the on-disk cache when possible."""
+    # Cache files are read and written on the default thread pool so disk I/O never stalls the event loop
+    content = await asyncio.to_thread(read_cached_page, page_url, byte_range)
+    if content is None and byte_range is not None: # A server that ignored Range left the full page cached instead
+        content = await asyncio.to_thread(read_cached_page, page_url)
+    if content is not None: # Only cache misses count against the rate limit
+        return content
+    headers = None if byte_range is None else {"Range": f"bytes={byte_range}"} # Merged with the session's HEADERS
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with semaphore, limiter:
+                async with session.get(page_url, headers=headers) as r:
+                    status = r.status
+                    retry_after = r.headers.get("Retry-After")
+                    if status in (200, 206):
+                        content = await r.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError): # Connection resets and timeouts back off like a 503
+            status, retry_after = None, None
+        if status in (200, 206):
+            break
+        if (status is not None and status not in RETRYABLE_STATUSES) or attempt == MAX_RETRIES:
+            return None # Give up on this page only, not the whole batch
+        # Back off outside the semaphore so a waiting page doesn't hold a request slot
+        await asyncio.sleep(retry_delay_seconds(attempt, retry_after))
+    if status == 200: # The server ignored the Range header and sent the whole page
+        byte_range = None
+    await asyncio.to_thread(write_cached_page, page_url, content, byte_range)
+    return content
+
+def infobox_image_url(content: bytes) -> str | None:
+    """Return the https://static.wikia.nocookie.net/... image URL in the infobox of a (possibly partial) page."""
+    tree = LexborHTMLParser(content)
 
     # 1️⃣ Try infobox img
-    img = soup.select_one("figure.pi-item.pi-image a.image-thumbnail img")
-    if img and img.get("src"):
-        full_url = img["src"]
+    img = tree.css_first(INFOBOX_IMAGE_SELECTOR)
+    if img and img.attributes.get("src"):
+        full_url = img.attributes["src"]
         # The src URL might be a versioned one with /revision/... Remove that part.
-        return full_url.split("/revision/")[0]
+        revision_index = full_url.find("/revision/")
+        return full_url if revision_index == -1 else full_url[:revision_index]
     return None
 
+async def fetch_image(session: aiohttp.ClientSession, page_url: str | None, semaphore: asyncio.Semaphore, limiter: AsyncLimiter) -> str | None:
+    """Return the infobox image URL of a wiki page, downloading only its first bytes when that is enough."""
+    if not page_url:
+        return None
+    # The infobox sits near the top of the page, so try a partial download before the full page
+    for byte_range in (INFOBOX_BYTE_RANGE, None):
+        content = await download_page(session, page_url, semaphore, limiter, byte_range)
+        if content is None:
+            return None
+        image_url = infobox_image_url(content)
+        if image_url:
+            return image_url
+    return None
+
+async def fetch_all_images(page_urls: list[str | None]) -> list[str | None]:
+    """Fetch the infobox image for every page concurrently, preserving input order."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+    # One pooled connector for the whole run: after the first request to the wiki host, later requests
+    # reuse the open keep-alive connections (and cached DNS) instead of a new TCP + TLS handshake
+    connector = aiohttp.TCPConnector(
+        limit_per_host=MAX_CONNECTIONS_PER_HOST,
+        keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS,
+        ttl_dns_cache=DNS_CACHE_TTL_SECONDS,
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT_SECONDS, sock_read=REQUEST_TIMEOUT_SECONDS)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS) as session:
+        tasks = [fetch_image(session, page_url, semaphore, limiter) for page_url in page_urls]
+        # Redraw the progress bar at most every 0.5s / 1% of pages so it doesn't contend with the fetches
+        return await tqdm.gather(*tasks, desc="Fetching photos", mininterval=0.5, miniters=max(1, len(tasks) // 100))
+
 def main() -> pl.DataFrame | None:
     """Main function to read CSV, fetch photos, and return a Polars DataFrame."""
     try:
-        df_nodes = pl.read_csv(CSV_NODES_INPUT)
+        df_nodes = pl.read_csv(CSV_NODES_INPUT) # Read eagerly: every row is fetched below
         print(f"ℹ️  Read {len(df_nodes)} rows from {CSV_NODES_INPUT}")
 
-        # Ensure 'photo_url' column exists and is initialized to None if not present, 
-        # or if we want to ensure it's blank before fetching
-        if "photo_url" not in df_nodes.columns:
-            df_nodes = df_nodes.with_columns(pl.lit(None).alias("photo_url").cast(pl.String))
-        else: # If it exists but we want to ensure it's treated as if it needs filling
-            df_nodes = df_nodes.with_columns(pl.col("photo_url").cast(pl.String)) # Ensure correct type
-
-        updated_rows = []
-        for row in tqdm(df_nodes.iter_rows(named=True), total=len(df_nodes), desc="Fetching photos"):
-            updated_row = row.copy() # Make a mutable copy
-            if row["wiki_page_url"] and isinstance(row["wiki_page_url"], str):
-                photo_url = first_static_image(row["wiki_page_url"])
-                updated_row["photo_url"] = photo_url if photo_url else ""
-            else:
-                updated_row["photo_url"] = ""
-            updated_rows.append(updated_row)
-            time.sleep(0.1) # Be polite to the server
-
-        df_filled_nodes = pl.DataFrame(updated_rows, schema=df_nodes.schema)
-        # print(f"✅  Photo fetching complete. Data is in memory.") # No longer saving to CSV_OUT here
+        # Blank URLs become None (skipped); Polars converts the whole column to a list in one call
+        page_urls = df_nodes.get_column("wiki_page_url").cast(pl.String).replace("", None).to_list()
+        photo_urls = asyncio.run(fetch_all_images(page_urls))
+
+        # Attach the fetched URLs as a single column, replacing any existing 'photo_url' values
+        df_filled_nodes = df_nodes.with_columns(
+            pl.Series("photo_url", photo_urls, dtype=pl.String).fill_null("")
+        )
         print(f"✅  Photo fetching complete. {len(df_filled_nodes)} nodes processed. Data is in memory.")
         return df_filled_nodes
         
@@ -98,51 +185,31 @@ def main() -> pl.DataFrame | None:
 def merge_node_info_to_edges_corrected(df_nodes_filled: pl.DataFrame):
     """Merges photo_url and wiki_page_url from the nodes DataFrame into the edges file for both source and target nodes."""
     try:
-        df_edges = pl.read_csv(CSV_EDGES_INPUT)
-        print(f"ℹ️  Read {len(df_edges)} edges from {CSV_EDGES_INPUT}.")
+        # Scan the edges lazily; both joins below stream from the scan to the sink and keep no per-edge state,
+        # so the merge uses no more memory than scanning and rewriting the CSV itself
+        df_edges = pl.scan_csv(CSV_EDGES_INPUT)
+        df_node_info = df_nodes_filled.lazy().select("name", "wiki_page_url", "photo_url")
         print(f"ℹ️  Using {len(df_nodes_filled)} nodes from in-memory DataFrame for merging.")
 
-        # Prepare a separate DataFrame for source node information with renamed columns
-        df_nodes_for_source_join = df_nodes_filled.select([
-            pl.col("name").alias("source_join_key"),
-            pl.col("wiki_page_url").alias("source_wiki_page_url"),
-            pl.col("photo_url").alias("source_photo_url")
-        ])
-
-        # Prepare a separate DataFrame for target node information with renamed columns
-        df_nodes_for_target_join = df_nodes_filled.select([
-            pl.col("name").alias("target_join_key"),
-            pl.col("wiki_page_url").alias("target_wiki_page_url"),
-            pl.col("photo_url").alias("target_photo_url")
-        ])
-        
-        # First join (source)
-        df_merged_with_source = df_edges.join(
-            df_nodes_for_source_join, # Use the fully prepared DataFrame
-            left_on="source_label",
-            right_on="source_join_key", # This key exists directly in df_nodes_for_source_join
-            how="left"
-        )
-
-        # Second join (target)
-        df_final_merged = df_merged_with_source.join(
-            df_nodes_for_target_join, # Use the fully prepared DataFrame
-            left_on="target_label",
-            right_on="target_join_key", # This key exists directly in df_nodes_for_target_join
-            how="left"
-        )
-
-        # Now, drop both temporary join keys at the very end
-        # Ensure the keys exist before dropping, to avoid new errors if the join still fails before this point
-        columns_to_drop = []
-        if "source_join_key" in df_final_merged.columns:
-            columns_to_drop.append("source_join_key")
-        if "target_join_key" in df_final_merged.columns:
-            columns_to_drop.append("target_join_key")
-        
-        df_to_write = df_final_merged.drop(columns_to_drop)
-
-        df_to_write.write_csv(CSV_FINAL_OUTPUT)
+        # Node names must be unique so both joins are many-to-one. This is checked once on the small node table:
+        # join-time validate="m:1" makes Polars fall back from streaming and load every edge into memory.
+        # maintain_order keeps the edges in their input order
+        if not df_nodes_filled.get_column("name").is_unique().all():
+            raise ValueError("node names in the nodes DataFrame are not unique")
+        df_final_merged = df_edges
+        for side in ("source", "target"):
+            df_final_merged = df_final_merged.join(
+                df_node_info.rename({"wiki_page_url": f"{side}_wiki_page_url", "photo_url": f"{side}_photo_url"}),
+                left_on=f"{side}_label",
+                right_on="name",
+                how="left",
+                maintain_order="left",
+            )
+
+        print(f"ℹ️  Read {df_edges.select(pl.len()).collect().item()} edges from {CSV_EDGES_INPUT}.")
+
+        # The joins append source_wiki_page_url, source_photo_url, target_wiki_page_url, target_photo_url after the edge columns
+        df_final_merged.sink_csv(CSV_FINAL_OUTPUT)
         print(f"✅  Successfully merged source and target node info into edges. Saved to {CSV_FINAL_OUTPUT}")
 
     except Exception as e:
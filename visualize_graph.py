@@ -1,12 +1,145 @@
 import polars as pl
-import networkx as nx
-from pyvis.network import Network
+import igraph as ig
+import hashlib
+import json
 import os
+import re
+from pathlib import Path
 
 # --- Configuration ---
 CSV_FINAL_OUTPUT = "output_character_relationships_with_details.csv"
 HTML_OUTPUT_FILENAME = "index.html" # Changed default output filename
 DEFAULT_IMAGE_PLACEHOLDER = "https://via.placeholder.com/150/CCCCCC/000000?Text=No+Image" # A placeholder if no image is found
+GRAPH_COLUMNS = ["source_label", "target_label", "source_photo_url", "target_photo_url", "relationship"] # Columns of CSV_FINAL_OUTPUT used here
+LAYOUT_CACHE_DIR = "layout_cache" # Node positions keyed by a hash of the graph, reused across runs
+LAYOUT_ALGORITHM = "igraph-kamada-kawai" # Part of the layout cache key, so switching algorithms recomputes
+LAYOUT_SCALE = 3000 # Node coordinates span [-LAYOUT_SCALE, LAYOUT_SCALE]
+
+# vis-network layout and interaction options. Label fonts are set once here and shared by every
+# node and edge instead of being repeated in each record. Serialized compactly into the template at import.
+GRAPH_OPTIONS = {
+    "nodes": {"font": {"size": 18, "color": "black"}},
+    "edges": {"font": {"size": 14, "align": "top"}, "arrows": {"to": {"enabled": False}}},
+    "physics": {"enabled": False},
+    "interaction": {"hover": True, "tooltipDelay": 200},
+}
+
+# Static page header: title, attribution and extra stylesheets. Filled into the template once at import.
+PAGE_TITLE = "The White Lotus Graph"
+PAGE_ATTRIBUTION = 'Vibecoded by <a href="https://linkedin.com/in/victorianoizquierdo" target="_blank" rel="noopener noreferrer" style="color: rgb(7, 81, 207); text-decoration: none;">Victoriano Izquierdo</a> from <a href="https://graphext.com" target="_blank" rel="noopener noreferrer" style="color: rgb(7, 81, 207); text-decoration: none;">Graphext</a>'
+PAGE_HEADER_HTML = f'''<div class="container text-left mt-4 mb-2">
+            <h1 style="font-family: 'Cinzel', serif; color: #333; font-size: 25px;">{PAGE_TITLE}</h1>
+        </div><div class="container text-left mb-4">
+            <p style="font-family: 'Arial', sans-serif; font-size: 1rem; color: #555;">{PAGE_ATTRIBUTION}</p>
+        </div>'''
+# Bootstrap CSS, Google Fonts CSS and custom styles, added at the end of <head>
+PAGE_HEAD_EXTRAS = (
+    '<link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">'
+    '<link href="https://fonts.googleapis.com/css2?family=Cinzel:wght@400..900&display=swap" rel="stylesheet">'
+    '''<style>
+              body {
+                background-color: #F7F6F1; /* Off-white background */
+                margin: 0;
+                padding: 0;
+              }
+              #mynetwork {
+                border: none !important; /* Remove border from graph container */
+              }
+            </style>'''
+)
+
+# Standalone vis-network page (modelled on pyvis' template). The static __HEAD_EXTRAS__, __PAGE_HEADER__ and
+# __OPTIONS_JSON__ markers are filled in at import; the graph data markers are filled in by create_graph_visualization.
+HTML_TEMPLATE = """<html>
+    <head>
+        <meta charset="utf-8">
+        <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/vis-network/9.1.2/dist/dist/vis-network.min.css" integrity="sha512-WgxfT5LWjfszlPHXRmBWHkV2eceiWTOBvrKCNbdgDYTHrT2AeLCGbF4sZlZw3UMN3WtL0tGUoIAKsu8mllg/XA==" crossorigin="anonymous" referrerpolicy="no-referrer" />
+        <script src="https://cdnjs.cloudflare.com/ajax/libs/vis-network/9.1.2/dist/vis-network.min.js" integrity="sha512-LnvoEWDFrqGHlHmDD2101OrLcbsfkrzoSpvtSQtxK3RMnRV0eOkhhBN2dXHKRrUU8p2DGRTk35n4O8nWSVe1mQ==" crossorigin="anonymous" referrerpolicy="no-referrer"></script>
+        <link
+          href="https://cdn.jsdelivr.net/npm/bootstrap@5.0.0-beta3/dist/css/bootstrap.min.css"
+          rel="stylesheet"
+          integrity="sha384-eOJMYsd53ii+scO/bJGFsiCZc+5NDVN2yr8+0RDqr0Ql0h+rP48ckxlpbzKgwra6"
+          crossorigin="anonymous"
+        />
+        <style type="text/css">
+             #mynetwork {
+                 width: 100%;
+                 height: 900px;
+                 background-color: #F7F6F1;
+                 border: 1px solid lightgray;
+                 position: relative;
+                 float: left;
+             }
+        </style>
+    __HEAD_EXTRAS__</head>
+    <body>__PAGE_HEADER__
+        <div class="card" style="width: 100%">
+            <div id="mynetwork" class="card-body"></div>
+        </div>
+        <script type="text/javascript">
+              var nodes = new vis.DataSet(__NODES_JSON__);
+              var edges = new vis.DataSet(__EDGES_JSON__);
+              var options = __OPTIONS_JSON__;
+              var network = new vis.Network(document.getElementById("mynetwork"), {nodes: nodes, edges: edges}, options);
+        </script>
+    </body>
+</html>
+"""
+TEMPLATE_MARKER_PATTERN = re.compile(r"__(NODES_JSON|EDGES_JSON)__") # Per-run graph data markers
+TEMPLATE_PIECES = [
+    piece.encode("utf-8") if piece_index % 2 == 0 else piece
+    for piece_index, piece in enumerate(TEMPLATE_MARKER_PATTERN.split(
+        HTML_TEMPLATE
+        .replace("__HEAD_EXTRAS__", PAGE_HEAD_EXTRAS)
+        .replace("__PAGE_HEADER__", PAGE_HEADER_HTML)
+        .replace("__OPTIONS_JSON__", json.dumps(GRAPH_OPTIONS, separators=(",", ":")))
+    ))
+] # Literal HTML, pre-encoded to UTF-8, at even indices; marker names at odd indices
+
+def compute_layout(nodes_df: pl.DataFrame, edges_df: pl.DataFrame) -> pl.DataFrame:
+    """Returns kamada-kawai positions as a (name, x, y) frame for the `name` nodes and `source_label`/`target_label` edges,
+    reusing the cached layout when the nodes and edges are unchanged."""
+    # Number the vertices in node order and translate both edge endpoints to those ids with joins
+    vertex_ids = nodes_df.select("name").with_row_index("vertex")
+    edge_ids = (
+        edges_df.select("source_label", "target_label")
+        .join(vertex_ids.rename({"name": "source_label", "vertex": "source"}), on="source_label", how="inner", maintain_order="left")
+        .join(vertex_ids.rename({"name": "target_label", "vertex": "target"}), on="target_label", how="inner", maintain_order="left")
+    )
+
+    graph_signature = repr((
+        LAYOUT_ALGORITHM,
+        vertex_ids.get_column("name").sort().to_list(),
+        edge_ids.select(
+            pl.min_horizontal("source_label", "target_label"),
+            pl.max_horizontal("source_label", "target_label").alias("other_label"),
+        ).sort(pl.all()).rows(),
+        LAYOUT_SCALE,
+    ))
+    cache_key = hashlib.blake2b(graph_signature.encode("utf-8"), digest_size=8).hexdigest()
+    cache_path = Path(LAYOUT_CACHE_DIR) / f"{cache_key}.parquet"
+    if cache_path.exists():
+        print(f"ℹ️  Reusing cached layout from {cache_path}.")
+        return pl.read_parquet(cache_path)
+
+    if vertex_ids.is_empty(): # igraph's Kamada-Kawai rejects an empty graph
+        return pl.DataFrame(schema={"name": pl.String, "x": pl.Float64, "y": pl.Float64})
+
+    # Build the igraph graph in one call from the integer edge list; its Kamada-Kawai runs in C
+    graph = ig.Graph(n=vertex_ids.height, edges=edge_ids.select("source", "target").rows())
+    layout = graph.layout_kamada_kawai()
+
+    # Center on the mean and scale so the largest coordinate is LAYOUT_SCALE (as networkx's scale= did)
+    coords_df = pl.DataFrame(layout.coords, schema={"x": pl.Float64, "y": pl.Float64}, orient="row")
+    coords_df = coords_df.select(pl.all() - pl.all().mean())
+    max_extent = coords_df.select(pl.max_horizontal(pl.all().abs().max())).item() or 1.0
+    positions_df = coords_df.select(
+        vertex_ids.get_column("name"),
+        pl.all() * (LAYOUT_SCALE / max_extent),
+    )
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    positions_df.write_parquet(cache_path)
+    return positions_df
 
 def create_graph_visualization():
     """Reads the merged data and creates an interactive graph visualization."""
@@ -14,200 +147,96 @@ def create_graph_visualization():
         print(f"❌ Error: Input file {CSV_FINAL_OUTPUT} not found. Please run the main script first.")
         return
 
-    try:
-        df_merged = pl.read_csv(CSV_FINAL_OUTPUT)
-        print(f"ℹ️  Read {len(df_merged)} relationships from {CSV_FINAL_OUTPUT}.")
-    except Exception as e:
-        print(f"❌ Error reading {CSV_FINAL_OUTPUT}: {e}")
-        return
-
-    # Create a NetworkX graph
-    nx_graph = nx.Graph()
-    
-    # Pyvis Network
-    # Adjusted height and width for better initial display
-    nt = Network(notebook=False, height="900px", width="100%", bgcolor="#F7F6F1", font_color="black")
-
-    # Populate NetworkX graph first
-    added_nodes_nx = set() # To track nodes added to nx_graph
+    # Lazy end to end: only the graph columns are parsed (projection pushdown), with their types given up front,
+    # and the merged relationships are never materialized; only the node and edge tables below are collected
+    df_merged = (
+        pl.scan_csv(CSV_FINAL_OUTPUT, schema_overrides={column: pl.String for column in GRAPH_COLUMNS})
+        .select(GRAPH_COLUMNS)
+    )
     node_size = 60
-    label_font_size = 20
-    edge_font_size = 14
-
-    for row in df_merged.iter_rows(named=True):
-        source_name = row.get("source_label")
-        target_name = row.get("target_label")
-        source_photo = row.get("source_photo_url") or DEFAULT_IMAGE_PLACEHOLDER
-        target_photo = row.get("target_photo_url") or DEFAULT_IMAGE_PLACEHOLDER
-        relationship = row.get("relationship") or "related"
-
-        # Add source node only if it's not already added and has a real photo
-        if source_name and source_name not in added_nodes_nx:
-            if source_photo != DEFAULT_IMAGE_PLACEHOLDER:
-                nx_graph.add_node(source_name, label=source_name, shape="image", image=source_photo, title=source_name, size=node_size, font_size=label_font_size)
-                added_nodes_nx.add(source_name)
-        
-        # Add target node only if it's not already added and has a real photo
-        if target_name and target_name not in added_nodes_nx:
-            if target_photo != DEFAULT_IMAGE_PLACEHOLDER:
-                nx_graph.add_node(target_name, label=target_name, shape="image", image=target_photo, title=target_name, size=node_size, font_size=label_font_size)
-                added_nodes_nx.add(target_name)
-        
-        # Add edge only if both source and target nodes have been added to the graph (i.e., they have real photos)
-        if source_name and target_name and \
-           source_name in added_nodes_nx and target_name in added_nodes_nx:
-            nx_graph.add_edge(source_name, target_name, title=relationship, label=relationship, font_size=edge_font_size)
-
-    # Calculate layout using NetworkX
-    # k controls the optimal distance between nodes. Larger k = more spread.
-    # iterations refine the layout.
-    # seed ensures reproducible layouts.
-    # pos = nx.spring_layout(nx_graph, k=12.0, iterations=550, seed=42) 
-    # scaling_factor = 700 # This variable is now effectively the 'scale' for kamada_kawai
-    pos = nx.kamada_kawai_layout(nx_graph, scale=3000) # Using existing scaling_factor for the scale parameter
-
-    # Add nodes to pyvis network with pre-calculated fixed positions
-    for node_id, (x, y) in pos.items():
-        node_attrs = nx_graph.nodes[node_id]
-        nt.add_node(
-            node_id,
-            x=x, # Coordinates from kamada_kawai_layout are already scaled
-            y=y, # Coordinates from kamada_kawai_layout are already scaled
-            fixed=True,
-            label=node_attrs.get('label', node_id),
-            shape="image", # Ensure shape is set
-            image=node_attrs.get('image', DEFAULT_IMAGE_PLACEHOLDER),
-            title=node_attrs.get('title', node_id),
-            size=node_attrs.get('size', node_size),
-            font={'size': node_attrs.get('font_size', label_font_size)} # Use stored font_size
-        )
 
-    # Add edges to pyvis network
-    for source, target, edge_attrs in nx_graph.edges(data=True):
-        nt.add_edge(
-            source,
-            target,
-            title=edge_attrs.get('title', 'related'),
-            label=edge_attrs.get('label', 'related'),
-            font={'size': edge_attrs.get('font_size', edge_font_size)} # Use stored font_size
+    # Stack source and target columns into one (name, photo) table in first-seen order (each row's source,
+    # then its target), then keep the first occurrence of each node that has a real photo
+    nodes_df = (
+        df_merged
+        .select(
+            pl.concat_list("source_label", "target_label").alias("name"),
+            pl.concat_list("source_photo_url", "target_photo_url").alias("photo"),
+        )
+        .explode(["name", "photo"])
+        .filter(
+            pl.col("name").is_not_null() & (pl.col("name") != "")
+            & pl.col("photo").is_not_null() & ~pl.col("photo").is_in(["", DEFAULT_IMAGE_PLACEHOLDER])
+        )
+        .unique(subset=["name"], keep="first", maintain_order=True)
+    )
+
+    # Keep only edges whose source and target both have real photos. As in an undirected graph,
+    # repeated pairs (in either direction) collapse into one edge carrying the last relationship.
+    # Photos live only in nodes_df, so the edge pass drops the photo columns before joining.
+    # The joins keep the CSV row order, which the streaming engine otherwise may not, so "last" stays well defined.
+    valid_node_names = nodes_df.select("name")
+    edges_df = (
+        df_merged
+        .select("source_label", "target_label", "relationship")
+        .filter(pl.col("source_label").is_not_null() & pl.col("target_label").is_not_null()) # Drop unlabeled rows before joining
+        .join(valid_node_names, left_on="source_label", right_on="name", how="semi", maintain_order="left")
+        .join(valid_node_names, left_on="target_label", right_on="name", how="semi", maintain_order="left")
+        .with_columns(
+            pl.min_horizontal("source_label", "target_label").alias("node_a"),
+            pl.max_horizontal("source_label", "target_label").alias("node_b"),
+            pl.col("relationship").fill_null("related"),
         )
+        .unique(subset=["node_a", "node_b"], keep="last", maintain_order=True)
+    )
 
-    # Add physics toggle buttons to the UI
-    # nt.show_buttons(filter_=['physics']) # Temporarily commented out for debugging
+    try:
+        # One streaming run for all three queries, so the CSV scan they share is executed once
+        relationship_count, nodes_df, edges_df = pl.collect_all(
+            [df_merged.select(pl.len()), nodes_df, edges_df], engine="streaming"
+        )
+        print(f"ℹ️  Read {relationship_count.item()} relationships from {CSV_FINAL_OUTPUT}.")
+    except Exception as e:
+        print(f"❌ Error reading {CSV_FINAL_OUTPUT}: {e}")
+        return
 
-    # Set advanced layout and interaction options using a JSON string
-    nt.set_options("""
-    {
-      "nodes": {
-        "font": {
-          "size": 18
-        }
-      },
-      "edges": {
-        "font": {
-          "size": 12,
-          "align": "top"
-        },
-        "arrows": {
-          "to": { "enabled": false }
-        }
-      },
-      "physics": {
-        "enabled": false
-      },
-      "interaction": {
-        "hover": true,
-        "tooltipDelay": 200
-      }
-    }
-    """)
+    # Calculate a fixed layout up front (physics is disabled in the browser)
+    positions_df = compute_layout(nodes_df, edges_df) # Cached on disk per graph
+
+    # vis-network node and edge records with pre-calculated fixed positions, serialized by Polars
+    nodes_records = nodes_df.join(positions_df, on="name", how="left", maintain_order="left").select(
+        pl.lit("#97c2fc").alias("color"),
+        pl.lit(True).alias("fixed"),
+        pl.col("name").alias("id"),
+        pl.col("photo").alias("image"),
+        pl.col("name").alias("label"),
+        pl.lit("image").alias("shape"),
+        pl.lit(node_size).alias("size"),
+        pl.col("name").alias("title"),
+        "x",
+        "y",
+    )
+    edges_records = edges_df.select(
+        pl.col("source_label").alias("from"),
+        pl.col("relationship").alias("label"),
+        pl.col("relationship").alias("title"),
+        pl.col("target_label").alias("to"),
+    )
 
     try:
-        nt.save_graph(HTML_OUTPUT_FILENAME)
+        # Stream the page piece by piece; node and edge records are written by Polars straight into the file
+        # instead of first being assembled into one large HTML string
+        template_values = {
+            "NODES_JSON": nodes_records,
+            "EDGES_JSON": edges_records,
+        }
+        with open(HTML_OUTPUT_FILENAME, "wb") as html_file: # Binary: nothing is re-encoded at write time
+            for piece_index, piece in enumerate(TEMPLATE_PIECES):
+                if piece_index % 2 == 0:
+                    html_file.write(piece)
+                else:
+                    template_values[piece].write_json(html_file)
         print(f"✅  Graph visualization saved to {HTML_OUTPUT_FILENAME}")
-
-        # Post-process HTML to add a styled title and attribution
-        with open(HTML_OUTPUT_FILENAME, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-
-        # Clean potential default pyvis elements from <head>
-        head_start_index = html_content.find('<head>')
-        head_end_index = html_content.find('</head>')
-
-        if head_start_index != -1 and head_end_index != -1:
-            head_content_start = head_start_index + len('<head>')
-            actual_head_content = html_content[head_content_start:head_end_index]
-            
-            # Patterns pyvis might add to <head>
-            pyvis_head_placeholders = [
-                "<center><hr></center>",
-                "<center><hr/></center>",
-                "<center><h1></h1></center>",
-                # Variants with newlines/indentation
-                "<center>\n<hr>\n</center>",
-                "<center>\n<hr/>\n</center>",
-                "<center>\n<h1></h1>\n</center>",
-            ]
-            
-            cleaned_head_content = actual_head_content
-            for placeholder in pyvis_head_placeholders:
-                cleaned_head_content = cleaned_head_content.replace(placeholder, "")
-            
-            if cleaned_head_content != actual_head_content:
-                html_content = html_content[:head_content_start] + cleaned_head_content + html_content[head_end_index:]
-                print("Cleaned default pyvis placeholders from <head>.")
-
-        title_text = "The White Lotus Graph"
-        styled_title_html = f'''<div class="container text-left mt-4 mb-2">
-            <h1 style="font-family: 'Cinzel', serif; color: #333; font-size: 25px;">{title_text}</h1>
-        </div>'''
-
-        attribution_text = 'Vibecoded by <a href="https://linkedin.com/in/victorianoizquierdo" target="_blank" rel="noopener noreferrer" style="color: rgb(7, 81, 207); text-decoration: none;">Victoriano Izquierdo</a> from <a href="https://graphext.com" target="_blank" rel="noopener noreferrer" style="color: rgb(7, 81, 207); text-decoration: none;">Graphext</a>'
-        attribution_html = f'''<div class="container text-left mb-4">
-            <p style="font-family: 'Arial', sans-serif; font-size: 1rem; color: #555;">{attribution_text}</p>
-        </div>'''
-
-        # Ensure <head> exists, or add it (though cleaning implies it does)
-        # Add Bootstrap CSS and Google Fonts CSS into the <head>
-        # Re-find head_end_index as html_content might have changed during cleaning
-        head_end_index = html_content.find('</head>') 
-        if head_start_index != -1 and head_end_index != -1: # Check again in case head was malformed/removed by error
-            # Ensure <head> tag itself wasn't removed if it was empty and cleaned to nothing
-            if html_content.find('<head>') == -1:
-                 # This case should be rare; if pyvis makes a head, it usually has other essential tags.
-                 # If truly empty and removed, we'd need to reconstruct it or insert before <body>.
-                 # For now, assume <head> tags persist.
-                 pass 
-            bootstrap_css = '<link href="https://stackpath.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">'
-            google_fonts_css = '<link href="https://fonts.googleapis.com/css2?family=Cinzel:wght@400..900&display=swap" rel="stylesheet">'
-            custom_styles_css = '''<style>
-              body {
-                background-color: #F7F6F1; /* Off-white background */
-                margin: 0;
-                padding: 0;
-              }
-              #mynetwork {
-                border: none !important; /* Remove border from graph container */
-              }
-            </style>'''
-            html_content = html_content[:head_end_index] + bootstrap_css + google_fonts_css + custom_styles_css + html_content[head_end_index:]
-        else:
-            print("Could not find </head> tag to insert Bootstrap, Google Fonts, and Custom CSS after cleaning.")
-
-        # Combine title and attribution
-        header_content = styled_title_html + attribution_html
-
-        # Insert the styled title and attribution after the <body> tag
-        body_tag_position = html_content.find('<body>')
-        if body_tag_position != -1:
-            body_tag_position += len('<body>')
-            html_content = html_content[:body_tag_position] + header_content + html_content[body_tag_position:]
-        else:
-            print("Could not find <body> tag to insert title and attribution.")
-
-        with open(HTML_OUTPUT_FILENAME, 'w', encoding='utf-8') as f:
-            f.write(html_content)
-        
         print(f"Title and attribution added to {HTML_OUTPUT_FILENAME}")
         print(f"You can open this file in your web browser to view the interactive graph.")
     except Exception as e: